@@ -7,52 +7,337 @@ AgentScopeの主要な機能を学ぶためのテストプロジェクトです
 - ユーザーエージェントとアシスタントエージェントの2体による対話
 - アシスタントエージェントへのツールの追加
 - AgentScope Studio (Webダッシュボード) との連携
+- 意味的に似た質問への応答キャッシュ
+- ユーザーの入力待ちの間にモデルを読み込んでおくウォームアップ
+- 応答のストリーミング表示と、Ctrl+Cによる生成の中断
+- 時刻を尋ねる質問への、LLMを介さない即答
+- Studioへのメッセージ転送のバックグラウンド化
 """
 
 import asyncio
+import gc
+import math
+import re
+import signal
+import threading
+import uuid
+import httpx
 import agentscope
-from agentscope.agent import ReActAgent, UserAgent
+from agentscope.agent import AgentBase, ReActAgent, UserAgent, UserInputBase, UserInputData
+from agentscope.embedding import OllamaTextEmbedding
 from agentscope.model import OllamaChatModel
 from agentscope.formatter import OllamaChatFormatter
 from agentscope.tool import Toolkit
 from agentscope.message import Msg
-import datetime
+import time
+
+# uvloopがインストールされていれば、標準よりも高速なイベントループを使用します。
+# (Windowsでは利用できないため、その場合は標準のイベントループを使用します。)
+# `uvloop.run`はuvloop 0.18以降にしかないため、それより古い場合も標準のイベントループを使用します。
+try:
+    from uvloop import run as uvloop_run
+except ImportError:
+    uvloop_run = None
 
 # --- 1. AgentScope Studioとの連携初期化 ---
 # AgentScopeの初期化を行います。
 # `studio_url`で接続先のAgentScope Studioのアドレスを指定します。
 # 事前に `as_studio` コマンドでWebダッシュボードを起動しておく必要があります。
 # 今回はポート3000で起動しているため、そのように指定します。
+# `run_id`は、Studio上でこの実行を識別するためのIDです。
+# 後述のメッセージ転送処理でも使用するため、ここで作成して指定しておきます。
+STUDIO_URL = "http://localhost:3000"
+STUDIO_RUN_ID = uuid.uuid4().hex
 print("AgentScope Studioへの接続を初期化しています...")
 agentscope.init(
-    studio_url="http://localhost:3000",
+    studio_url=STUDIO_URL,
+    run_id=STUDIO_RUN_ID,
 )
 print("初期化が完了しました。")
 
+# Studioと連携すると、エージェントがメッセージを表示するたびに、フックの中で
+# Studioへメッセージが同期的に送信されます。この送信はイベントループを止めてしまい、
+# ストリーミング表示では生成されたチャンクごとに送信が発生します。
+# そこで、組み込みのフックを外して、メッセージをキューに追加するだけのフックに置き換え、
+# 実際の送信はバックグラウンドのタスク(`forward_studio_messages`)で行います。
+# キューの大きさには上限を設け、満杯になった場合は最も古いメッセージを捨てます。
+studio_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+
+def enqueue_studio_message(self: AgentBase, kwargs: dict) -> None:
+    """
+    表示されるメッセージを、Studioへの送信キューに追加する`pre_print`フックです。
+    """
+    msg = kwargs["msg"]
+    payload = {
+        "runId": STUDIO_RUN_ID,
+        "replyId": getattr(self, "_reply_id", None) or uuid.uuid4().hex,
+        "replyName": getattr(self, "name", msg.name),
+        "replyRole": "user" if isinstance(self, UserAgent) else "assistant",
+        "msg": msg.to_dict(),
+    }
+    if studio_queue.full():
+        studio_queue.get_nowait()
+        studio_queue.task_done()
+    studio_queue.put_nowait(payload)
+
+AgentBase.remove_class_hook("pre_print", "as_studio_forward_message_pre_print_hook")
+AgentBase.register_class_hook("pre_print", "enqueue_studio_message", enqueue_studio_message)
+
+async def forward_studio_messages(client: httpx.AsyncClient, max_retries: int = 3) -> None:
+    """
+    キューに追加されたメッセージを、順番にStudioへ送信し続けます。
+    通信に失敗した場合は`max_retries`回まで再送し、それでも失敗したメッセージは諦めます。
+    1つのメッセージの送信でどのようなエラーが起きても、以降のメッセージの転送は続けます。
+    """
+    while True:
+        payload = await studio_queue.get()
+        try:
+            for n_retry in range(max_retries + 1):
+                try:
+                    res = await client.post("/trpc/pushMessage", json=payload)
+                    res.raise_for_status()
+                    break
+                except httpx.HTTPError as e:
+                    if n_retry == max_retries:
+                        print(f"Studioへのメッセージの転送に失敗しました: {e}")
+                except Exception as e:
+                    # メッセージをJSONに変換できない場合などは、再送しても結果は変わらないため
+                    # このメッセージだけを諦めます。
+                    print(f"Studioへのメッセージの転送に失敗しました: {e}")
+                    break
+        finally:
+            studio_queue.task_done()
+
 # --- 2. ツールの定義 ---
 # エージェントが使用できるツールを定義します。
 # ツールとして使用する関数は、通常のPython関数として定義します。
+# 結果は秒単位でしか変わらないため、同じ秒のうちに呼ばれた場合は前回の文字列を返します。
+# また、ロケールの処理を伴う`strftime`の代わりに、f文字列で直接組み立てます。
+_last_time_sec = 0
+_last_time_str = ""
+
 def get_current_time() -> str:
     """
     現在の時刻を「YYYY-MM-DD HH:MM:SS」の形式で取得します。
     """
-    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    global _last_time_sec, _last_time_str
+    now = int(time.time())
+    if now != _last_time_sec:
+        lt = time.localtime(now)
+        _last_time_str = (
+            f"{lt.tm_year:04d}-{lt.tm_mon:02d}-{lt.tm_mday:02d} "
+            f"{lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
+        )
+        _last_time_sec = now
+    return _last_time_str
+
+# 「今の時間は？」のような時刻を尋ねるだけの質問は、答えが`get_current_time`の結果で
+# 決まるため、LLMに推論とツール呼び出しをさせずに直接応答します。
+# 「今の時間帯に空いている店は？」や「What time is it in London?」のように、
+# 時刻に関する言葉を含むだけの別の質問を誤って即答しないよう、メッセージ全体が
+# 時刻を尋ねる決まった言い回し（先頭のあいさつは可）である場合だけを対象にします。
+TIME_QUERY_PATTERN = re.compile(
+    r"^\s*"
+    r"((こんにちは|こんばんは|おはよう(ございます)?)[、,。!！\s]*)?"
+    r"("
+    r"(今|現在)の?(時間|時刻)(は|を教えて(ください)?)?"
+    r"|今何時(ですか)?"
+    r"|what time is it( now)?"
+    r"|what(\s+is|'s) the (current )?time( now)?"
+    r"|(the )?current time"
+    r")"
+    r"[?？]?\s*$",
+    re.IGNORECASE,
+)
+
+def is_time_query(msg: Msg) -> bool:
+    """
+    メッセージが時刻を尋ねるだけの質問かどうかを判定します。
+    """
+    text = msg.get_text_content() or ""
+    return TIME_QUERY_PATTERN.match(text) is not None
 
 # --- 3. モデルの設定 ---
 # エージェントが使用するLLMモデルを設定します。
 # ここでは、ローカルのOllamaで起動している 'gpt-oss:20b' モデルを使用します。
 # `OllamaChatModel`クラスを使用し、`model_name`にモデル名を指定します。
 # `max_tokens`はモデルが一度に生成するトークンの最大数です。
+# `keep_alive`はOllamaがモデルをメモリに保持する時間です。
+# Ollamaは直前のリクエストと先頭が一致する部分（システムプロンプトとツール定義）の
+# KVキャッシュを自動的に再利用するため、ユーザーが入力を考えている間にモデルが
+# アンロードされないよう、`-1`（無期限）を指定してメモリに常駐させます。
+# 常駐させたモデルは、'exit'で対話を終了するときにメモリから解放します。
 print("Ollamaモデルを設定しています...")
+# `limits`は、Ollamaとの通信に使うHTTPクライアントの接続プールの設定です。
+# 接続を保持する時間を延ばし、ターンごとに接続し直さないようにします。
+# `stream=True`にすると、応答が生成されたそばから少しずつコンソールに表示されるため、
+# 応答全体の生成を待たずに読み始めることができます。
 ollama_model = OllamaChatModel(
     model_name="gpt-oss:20b",
+    stream=True,
+    keep_alive=-1,
+    limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=1800),
 )
+
+# 応答キャッシュで質問文の類似度を計算するための埋め込みモデルです。
+# 日本語の質問を比較するため、多言語に対応した 'bge-m3' を使用します。
+# 事前に `ollama pull bge-m3` でダウンロードしておいてください。
+# (ダウンロードしていない場合は、キャッシュを使わずに通常どおり応答します)
+# 接続先は同じOllamaなので、チャットモデルのHTTPクライアントを共有します。
+embedding_model = OllamaTextEmbedding(
+    model_name="bge-m3",
+    dimensions=1024,
+)
+embedding_model.client = ollama_model.client
 print("モデルの設定が完了しました。")
 
 
+async def warmup_model(model: OllamaChatModel) -> None:
+    """
+    Ollamaにモデルを読み込ませ、メモリに保持させておきます。
+    プロンプトを指定しない`generate`はモデルの読み込みだけを行い、テキストは生成しません。
+    読み込みは高速化のための下準備にすぎないため、失敗しても例外は送出しません。
+    (Ollamaに接続できないなどの問題は、エージェントが応答するときに改めて表示されます)
+    """
+    try:
+        await model.client.generate(model=model.model_name, keep_alive=model.keep_alive)
+    except Exception:
+        pass
+
+
+async def unload_model(model: OllamaChatModel) -> None:
+    """
+    `keep_alive=0`を指定して、常駐させていたモデルをOllamaのメモリから解放します。
+    解放に失敗しても、プログラムの終了を妨げないように例外は送出しません。
+    """
+    try:
+        await model.client.generate(model=model.model_name, keep_alive=0)
+    except Exception as e:
+        print(f"モデルを解放できませんでした（`ollama stop {model.model_name}`で解放できます）: {e}")
+
+
 # --- 4. エージェントの作成 ---
 # 対話に参加するエージェントを2体作成します。
 
+# 言い回しが違うだけの同じ質問のたびにLLMを呼び出さないよう、
+# ReActAgentを継承して応答キャッシュを追加します。
+class CachedReActAgent(ReActAgent):
+    """
+    意味的に似た質問に対して、過去の応答を再利用するReActAgent。
+
+    質問文の埋め込みベクトルを計算し、コサイン類似度が`similarity_threshold`以上の
+    質問がキャッシュにあれば、LLMを呼び出さずにその応答を返します。
+    時刻の取得のように結果が毎回変わりうるため、ツールを使ったターンの応答は
+    キャッシュしません。
+    また、「はい」「もっと詳しく」のように直前の会話によって意味が変わる短い返答や
+    指示語を含む質問は、キャッシュの対象にしません。
+    時刻を尋ねるだけの質問には、キャッシュを確認する前に`get_current_time`の結果で即答します。
+    埋め込みモデルを呼び出せない場合は、キャッシュを無効にして通常どおり応答します。
+    """
+
+    # これより短い質問は、直前の会話に依存した返答とみなしてキャッシュしません。
+    MIN_QUERY_LENGTH = 8
+    # 直前の会話を指す言葉を含む質問も、同じ文面でも答えが変わるためキャッシュしません。
+    CONTEXT_DEPENDENT_PATTERN = re.compile(
+        r"(それ|これ|あれ|その|この|続け|もっと|さっき|先ほど|さきほど|前の|詳しく|はい|いいえ)"
+    )
+
+    def __init__(
+        self,
+        embedding_model: OllamaTextEmbedding,
+        similarity_threshold: float = 0.9,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.embedding_model = embedding_model
+        # しきい値は、このリポジトリでは日本語の質問を使って計測・調整していません。
+        # 別の質問に過去の応答を返してしまう誤りは、キャッシュを使えずLLMを呼び出すだけの
+        # 見逃しよりも問題が大きいため、あえて高めの値にしています。
+        # 利用する質問に合わせて調整する場合は、`_lookup`で計算される類似度を確認してください。
+        self.similarity_threshold = similarity_threshold
+        self._cache_enabled = True
+        # (質問の埋め込みベクトル, 応答メッセージ) のリスト
+        self._response_cache: list[tuple[list[float], Msg]] = []
+
+    @staticmethod
+    def _cosine_similarity(a: list[float], b: list[float]) -> float:
+        """2つのベクトルのコサイン類似度を計算します。"""
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm else 0.0
+
+    def _lookup(self, embedding: list[float]) -> Msg | None:
+        """最も似ている質問の類似度がしきい値以上なら、その応答を返します。"""
+        best_score, best_msg = 0.0, None
+        for cached_embedding, cached_msg in self._response_cache:
+            score = self._cosine_similarity(embedding, cached_embedding)
+            if score > best_score:
+                best_score, best_msg = score, cached_msg
+        if best_score >= self.similarity_threshold:
+            return best_msg
+        return None
+
+    def _is_cacheable(self, query: str | None) -> bool:
+        """直前の会話に依存せず、単独で意味が通じる質問かどうかを判定します。"""
+        return (
+            query is not None
+            and len(query.strip()) >= self.MIN_QUERY_LENGTH
+            and self.CONTEXT_DEPENDENT_PATTERN.search(query) is None
+        )
+
+    async def _reply_directly(self, msg: Msg, content: str) -> Msg:
+        """
+        LLMを呼び出さずに応答します。
+        会話の流れが途切れないように、質問と応答をメモリに記録し、コンソールに表示します。
+        """
+        reply_msg = Msg(name=self.name, content=content, role="assistant")
+        await self.memory.add(msg)
+        await self.memory.add(reply_msg)
+        await self.print(reply_msg)
+        return reply_msg
+
+    async def reply(self, msg: Msg | None = None, **kwargs) -> Msg:
+        """キャッシュを確認し、見つからなければ通常どおりReActAgentとして応答します。"""
+        query = msg.get_text_content() if isinstance(msg, Msg) else None
+
+        # 時刻を尋ねるだけの質問は、キャッシュを確認せずに現在の時刻で応答します。
+        # (`reply`の中で応答するため、`__call__`によるStudioへの転送なども通常どおり行われます)
+        if kwargs.get("structured_model") is None and query and is_time_query(msg):
+            return await self._reply_directly(
+                msg, f"現在の時刻は {get_current_time()} です。",
+            )
+
+        if (
+            not self._cache_enabled
+            or not self._is_cacheable(query)
+            or kwargs.get("structured_model") is not None
+        ):
+            return await super().reply(msg, **kwargs)
+
+        try:
+            response = await self.embedding_model([query])
+        except Exception as e:
+            # 埋め込みモデルがダウンロードされていない場合などは、以降キャッシュを使いません。
+            print(f"応答キャッシュを無効にします（埋め込みモデルを利用できません: {e}）")
+            self._cache_enabled = False
+            return await super().reply(msg, **kwargs)
+        embedding = response.embeddings[0]
+
+        cached_msg = self._lookup(embedding)
+        if cached_msg is not None:
+            return await self._reply_directly(msg, cached_msg.content)
+
+        known_ids = {m.id for m in await self.memory.get_memory()}
+        reply_msg = await super().reply(msg, **kwargs)
+
+        # このターンでツールが呼び出されていなければキャッシュに登録します。
+        new_msgs = [
+            m for m in await self.memory.get_memory() if m.id not in known_ids
+        ]
+        if not any(m.has_content_blocks("tool_use") for m in new_msgs):
+            self._response_cache.append((embedding, reply_msg))
+        return reply_msg
+
 # (1) アシスタントエージェント (ReActAgent)
 # ReAct (Reasoning and Acting) の思考プロセスを持つエージェントです。
 # まず、ツールを登録するためのToolkitオブジェクトを作成します。
@@ -63,7 +348,8 @@ toolkit.register_tool_function(get_current_time)
 # `model`に先ほど設定したOllamaモデルを渡します。
 # `toolkit`に作成したツールキットを渡します。
 print("アシスタントエージェントを作成しています...")
-assistant_agent = ReActAgent(
+assistant_agent = CachedReActAgent(
+    embedding_model=embedding_model,
     name="アシスタント",
     sys_prompt="あなたは親切なアシスタントです。ユーザーの質問に答えたり、タスクを手伝ったりします。必要に応じて利用可能なツールを使ってください。",
     model=ollama_model,
@@ -74,12 +360,68 @@ assistant_agent = ReActAgent(
 # (2) ユーザーエージェント (UserAgent)
 # ユーザーからの入力を受け取り、対話の起点となるエージェントです。
 # デフォルトでコンソールからの入力を待ち受けます。
+# Studioと連携している場合は、Studioの画面からの入力を待ち受けます。
+
+# `UserAgent`の入力方法（コンソールの`input()`やStudioからの入力）は、入力を待つ間
+# イベントループを止めてしまいます。入力待ちの間も他の処理（モデルのウォームアップなど）を
+# 進められるよう、入力方法を別スレッドで実行するラッパーを用意します。
+class ThreadedUserInput(UserInputBase):
+    """
+    既存の入力方法を別スレッドで実行するための入力方法です。
+    """
+
+    def __init__(self, input_method: UserInputBase) -> None:
+        self.input_method = input_method
+
+    async def __call__(
+        self,
+        agent_id: str,
+        agent_name: str,
+        *args,
+        structured_model=None,
+        **kwargs,
+    ) -> UserInputData:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_future(setter, value) -> None:
+            if not future.done():
+                setter(value)
+
+        def run_input_method() -> None:
+            # 元の入力方法は、別スレッド上の新しいイベントループで実行します。
+            try:
+                result = asyncio.run(
+                    self.input_method(
+                        agent_id,
+                        agent_name,
+                        *args,
+                        structured_model=structured_model,
+                        **kwargs,
+                    ),
+                )
+            except BaseException as e:
+                loop.call_soon_threadsafe(set_future, future.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(set_future, future.set_result, result)
+
+        # デーモンスレッドで実行しておくと、入力待ちの間にCtrl+Cが押されたときに、
+        # 入力の完了を待たずにプログラムを終了できます。
+        threading.Thread(target=run_input_method, daemon=True).start()
+        return await future
+
+
 print("ユーザーエージェントを作成しています...")
 user_agent = UserAgent(
     name="ユーザー",
 )
+# `agentscope.init()`で設定された現在の入力方法を、別スレッドで実行するようにします。
+user_agent.override_instance_input_method(
+    ThreadedUserInput(UserAgent._input_method),
+)
 print("エージェントの作成が完了しました。")
 
+
 # --- 5. 対話の実行 ---
 # 作成したエージェント間で対話を実行します。
 # `async def` を使って非同期関数として定義するのが一般的です。
@@ -89,14 +431,26 @@ async def main() -> None:
     """
     print("\n--- 対話を開始します ---")
     print("対話を終了するには 'exit' と入力してください。")
+    print("応答の生成中にCtrl+Cを押すと、その応答の生成を中断します。")
     print("最初の質問を入力してください。例: こんにちは、今の時間は？")
 
+    loop = asyncio.get_running_loop()
+
+    # Studioへメッセージを転送するバックグラウンドタスクを開始します。
+    studio_client = httpx.AsyncClient(base_url=STUDIO_URL)
+    forward_task = asyncio.create_task(forward_studio_messages(studio_client))
+
     # メッセージをNoneで初期化してループを開始
     msg = None
 
     while True:
         # ユーザーからの入力を待つ。初回呼び出しではmsgがNone
-        msg = await user_agent(msg)
+        # 入力を待つ間に、Ollamaへモデルを読み込ませておきます。
+        # こうすることで、入力後の最初の応答でモデルの読み込みを待たずに済みます。
+        msg, _ = await asyncio.gather(
+            user_agent(msg),
+            warmup_model(ollama_model),
+        )
 
         # 'exit'が入力されたらループを抜ける
         if msg.content == "exit":
@@ -104,11 +458,49 @@ async def main() -> None:
             break
 
         # アシスタントエージェントが応答を生成する
-        msg = await assistant_agent(msg)
+        # 生成中にCtrl+Cが押された場合は、プログラムを終了せずに`interrupt()`で
+        # 応答の生成だけを中断します。Windowsではシグナルハンドラを登録できないため、
+        # 通常どおりプログラムが中断されます。
+        try:
+            loop.add_signal_handler(
+                signal.SIGINT,
+                lambda: asyncio.ensure_future(assistant_agent.interrupt()),
+            )
+        except NotImplementedError:
+            pass
+        try:
+            msg = await assistant_agent(msg)
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except NotImplementedError:
+                pass
+
+    # 常駐させていたモデルを解放してから、共有していたHTTPクライアントの接続を閉じます。
+    await unload_model(ollama_model)
+    await ollama_model.client.close()
+
+    # 送信待ちのメッセージをStudioへ送り終えてから、転送タスクを終了します。
+    # Studioが応答しない場合に終了できなくならないよう、待つ時間には上限を設けます。
+    try:
+        await asyncio.wait_for(studio_queue.join(), timeout=5)
+    except asyncio.TimeoutError:
+        print("Studioへ送信できなかったメッセージがあります。")
+    forward_task.cancel()
+    try:
+        await forward_task
+    except asyncio.CancelledError:
+        pass
+    await studio_client.aclose()
 
 # Pythonの非同期イベントループを開始して、main関数を実行します。
 if __name__ == "__main__":
+    # ここまでに作成したモデルやエージェントなどのオブジェクトは、プログラムの終了まで使い続けます。
+    # `gc.freeze()`でこれらをガベージコレクションの対象から外しておくと、対話が長く続いても
+    # ガベージコレクションのたびにこれらを走査せずに済み、処理の一時停止が短くなります。
+    gc.freeze()
     try:
-        asyncio.run(main())
+        run = uvloop_run if uvloop_run is not None else asyncio.run
+        run(main())
     except KeyboardInterrupt:
         print("\nプログラムが中断されました。")
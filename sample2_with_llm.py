@@ -28,6 +28,14 @@ from agentscope.model import OllamaChatModel
 from agentscope.formatter import OllamaChatFormatter
 from agentscope.message import Msg
 
+# uvloopがインストールされていれば、標準よりも高速なイベントループを使用します。
+# (Windowsでは利用できないため、その場合は標準のイベントループを使用します。)
+# `uvloop.run`はuvloop 0.18以降にしかないため、それより古い場合も標準のイベントループを使用します。
+try:
+    from uvloop import run as uvloop_run
+except ImportError:
+    uvloop_run = None
+
 async def main():
     # --- 1. AgentScope Studioとの連携初期化 ---
     # `studio_url` を指定すると、対話の様子をWebダッシュボードで視覚的に確認できます。
@@ -47,11 +55,29 @@ async def main():
     print("Ollamaモデルを設定しています...")
     # 'gpt-oss:20b' を使用します。
     # もし動作が重い場合は、'gemma:2b' など、より軽量なモデルに変更してください。
+    # なお、Ollamaで配布されているモデルは標準で4bitに量子化されています。
+    # 量子化の形式は `ollama show <モデル名>` で確認でき、タグを指定して変更することもできます。
+    # `keep_alive` は、Ollamaがモデルをメモリに保持しておく時間です。
+    # モデルが読み込まれたままであれば、毎ターン同じ内容で始まるシステムプロンプト部分の
+    # 計算結果（KVキャッシュ）をOllamaが再利用するため、2回目以降の応答が速くなります。
+    # `-1` を指定すると、モデルを無期限にメモリへ常駐させます。（'exit'で終了するときに解放します）
+    # `stream=True` にすると、応答が生成されたそばから少しずつコンソールに表示されます。
     llm_model = OllamaChatModel(
         model_name="gpt-oss:20b",
+        stream=True,
+        keep_alive=-1,
     )
     print(f"モデル '{llm_model.model_name}' の設定が完了しました。")
 
+    # 大きなモデルは読み込みに時間がかかるため、最初の質問を入力する前に
+    # Ollamaへモデルを読み込ませておきます。
+    # プロンプトを指定しない `generate` は、モデルの読み込みだけを行います。
+    print("モデルを読み込んでいます...")
+    await llm_model.client.generate(
+        model=llm_model.model_name,
+        keep_alive=llm_model.keep_alive,
+    )
+
 
     # --- 3. エージェントの作成 ---
     # (1) アシスタントエージェント (ReActAgent)
@@ -100,10 +126,16 @@ async def main():
         # `user_agent`によってコンソールに表示されるようにします。
         msg = assistant_response
 
+    # `keep_alive=-1` で常駐させたモデルは、プログラムを終了してもOllamaのメモリに残り続けます。
+    # 終了する前に `keep_alive=0` を指定してモデルを解放し、HTTPクライアントの接続を閉じます。
+    await llm_model.client.generate(model=llm_model.model_name, keep_alive=0)
+    await llm_model.client.close()
+
 # --- 5. 非同期関数の実行 ---
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        run = uvloop_run if uvloop_run is not None else asyncio.run
+        run(main())
     except KeyboardInterrupt:
         print("\nプログラムが中断されました。")
     except Exception as e:
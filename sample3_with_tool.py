@@ -19,7 +19,7 @@ LLMの判断でそのツールを使わせる方法を学びます。
 """
 
 import asyncio
-import datetime
+import time
 import agentscope
 from agentscope.agent import ReActAgent, UserAgent
 from agentscope.model import OllamaChatModel
@@ -27,19 +27,43 @@ from agentscope.formatter import OllamaChatFormatter
 from agentscope.tool import Toolkit
 from agentscope.message import Msg
 
+# uvloopがインストールされていれば、標準よりも高速なイベントループを使用します。
+# (Windowsでは利用できないため、その場合は標準のイベントループを使用します。)
+# `uvloop.run`はuvloop 0.18以降にしかないため、それより古い場合も標準のイベントループを使用します。
+try:
+    from uvloop import run as uvloop_run
+except ImportError:
+    uvloop_run = None
+
 # --- 1. ツールの定義 ---
 # エージェントが使用できるツールを、通常のPython関数として定義します。
 # ★重要★
 # 関数のdocstring（三重クォートで囲まれた説明文）は非常に重要です。
 # LLMはこのdocstringを読んで、いつ、どのようにこのツールを使うべきかを判断します。
 # そのため、引数や返り値について分かりやすく記述する必要があります。
+#
+# 時刻の文字列は秒単位でしか変わらないため、同じ秒のうちに呼ばれた場合は
+# 前回作成した文字列をそのまま返します。また、ロケールの処理を伴う`strftime`は
+# 比較的遅いため、`time.localtime`の値からf文字列で直接組み立てます。
+_last_time_sec = 0
+_last_time_str = ""
+
 def get_current_time() -> str:
     """
     現在の時刻を「YYYY-MM-DD HH:MM:SS」の形式で取得します。
     この関数は引数を必要としません。
     """
+    global _last_time_sec, _last_time_str
     print("\n--- [ツール実行] get_current_timeが呼び出されました ---")
-    result = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    now = int(time.time())
+    if now != _last_time_sec:
+        lt = time.localtime(now)
+        _last_time_str = (
+            f"{lt.tm_year:04d}-{lt.tm_mon:02d}-{lt.tm_mday:02d} "
+            f"{lt.tm_hour:02d}:{lt.tm_min:02d}:{lt.tm_sec:02d}"
+        )
+        _last_time_sec = now
+    result = _last_time_str
     print(f"--- [ツール実行] 結果: {result} ---\n")
     return result
 
@@ -50,11 +74,23 @@ async def main():
 
     # --- 2. モデルの設定 ---
     print("Ollamaモデルを設定しています...")
+    # `keep_alive=-1` でモデルをメモリに常駐させておくと、システムプロンプトとツール定義からなる
+    # 共通の先頭部分のKVキャッシュがターンをまたいで再利用されます。（'exit'で終了するときに解放します）
+    # `stream=True` にすると、応答が生成されたそばから少しずつコンソールに表示されます。
     llm_model = OllamaChatModel(
         model_name="gemma:2b",
+        stream=True,
+        keep_alive=-1,
     )
     print(f"モデル '{llm_model.model_name}' の設定が完了しました。")
 
+    # 最初の質問を入力する前に、Ollamaへモデルを読み込ませておきます。
+    print("モデルを読み込んでいます...")
+    await llm_model.client.generate(
+        model=llm_model.model_name,
+        keep_alive=llm_model.keep_alive,
+    )
+
     # --- 3. ツールキットの作成 ---
     # `Toolkit`オブジェクトを作成し、定義した関数をツールとして登録します。
     print("ツールキットを作成し、ツールを登録しています...")
@@ -97,10 +133,16 @@ async def main():
         assistant_response = await assistant_agent(msg)
         msg = assistant_response
 
+    # `keep_alive=-1` で常駐させたモデルは、プログラムを終了してもOllamaのメモリに残り続けます。
+    # 終了する前に `keep_alive=0` を指定してモデルを解放し、HTTPクライアントの接続を閉じます。
+    await llm_model.client.generate(model=llm_model.model_name, keep_alive=0)
+    await llm_model.client.close()
+
 # --- 6. 非同期関数の実行 ---
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        run = uvloop_run if uvloop_run is not None else asyncio.run
+        run(main())
     except KeyboardInterrupt:
         print("\nプログラムが中断されました。")
     except Exception as e:
@@ -12,6 +12,8 @@ AgentScope学習用サンプル4：複数エージェントの協調
 【このサンプルで学べること】
 - 複数のLLMエージェントに異なる役割（プロンプト）を与えて設定する方法
 - 特定の順序でエージェントを呼び出し、対話フローを制御する方法
+- `asyncio.gather` を使って、独立したエージェントの処理を並行して実行する方法
+- 2つの役割を1回のLLM呼び出しにまとめるカスタムエージェントの作り方
 - エージェント間の協調によって、より質の高い応答を生成する考え方
 
 【事前準備】
@@ -20,33 +22,295 @@ AgentScope学習用サンプル4：複数エージェントの協調
 【実行時のヒント】
 - 起動後、「Pythonを学ぶための計画を立てて」や「3日間の旅行プランを考えて」など、
   計画を立ててほしいタスクを入力してみてください。
+- `python sample4_multi_agent.py --joint` で起動すると、計画の立案とレビューを
+  1回のLLM呼び出しでまとめて行います。
+- `python sample4_multi_agent.py --batch tasks.txt` で起動すると、1行に1つずつ
+  タスクを書いたファイルを読み込み、複数のタスクを並行して処理します。
 """
 
+import argparse
 import asyncio
+import sys
+import httpx
 import agentscope
-from agentscope.agent import ReActAgent, UserAgent
-from agentscope.model import OllamaChatModel
+from agentscope.agent import AgentBase, ReActAgent, UserAgent
+from agentscope.model import ChatResponse, OllamaChatModel
 from agentscope.formatter import OllamaChatFormatter
+from agentscope.memory import InMemoryMemory
 from agentscope.message import Msg
 
-async def main():
+# uvloopがインストールされていれば、標準よりも高速なイベントループを使用します。
+# (Windowsでは利用できないため、その場合は標準のイベントループを使用します。)
+# `uvloop.run`はuvloop 0.18以降にしかないため、それより古い場合も標準のイベントループを使用します。
+try:
+    from uvloop import run as uvloop_run
+except ImportError:
+    uvloop_run = None
+
+# プランナーとクリティックの役割を定義するシステムプロンプトです。
+# 通常の実行方法のほか、`--joint`と`--batch`でも同じ内容を使用します。
+PLANNER_SYS_PROMPT = "あなたは優秀な計画立案者です。ユーザーから与えられたタスクに対して、具体的で実行可能なステップバイステップの計画を作成してください。"
+CRITIC_SYS_PROMPT = "あなたは優秀な批評家です。与えられた計画を注意深くレビューし、その計画の潜在的な問題点、欠けている視点、改善のための具体的な提案を指摘してください。"
+
+
+# --- 0-1. 計画の立案とレビューをまとめて行うエージェント ---
+# `--joint` オプションを指定した場合に使用します。
+# プランナーとクリティックの役割を1つのシステムプロンプトにまとめ、1回のリクエストで
+# 計画案と改善案の両方を生成させます。出力は目印（マーカー）で区切って2つに分割します。
+# リクエストが1回で済むため、HTTP通信やプロンプトの処理にかかる時間を減らせます。
+class JointPlannerCritic(AgentBase):
+    """
+    プランナーとクリティックの役割を、1回のLLM呼び出しで実行するエージェント。
+    応答メッセージの`metadata`に、分割した計画案(`plan`)と改善案(`critique`)を格納して返します。
+    これまでのタスクと応答はメモリに記録し、次のリクエストのプロンプトに含めます。
+    """
+
+    PLAN_START, PLAN_END = "<<PLAN>>", "<<END_PLAN>>"
+    CRITIQUE_START, CRITIQUE_END = "<<CRITIQUE>>", "<<END_CRITIQUE>>"
+
+    def __init__(
+        self,
+        name: str,
+        planner_sys_prompt: str,
+        critic_sys_prompt: str,
+        model: OllamaChatModel,
+        formatter: OllamaChatFormatter,
+    ):
+        super().__init__()
+        self.name = name
+        self.model = model
+        self.formatter = formatter
+        self.memory = InMemoryMemory()
+        self.sys_prompt = (
+            f"<ROLE:PLANNER>{planner_sys_prompt}\n"
+            f"<ROLE:CRITIC>{critic_sys_prompt}\n"
+            "あなたは上記の2つの役割を順番に担当します。"
+            "まずプランナーとしてユーザーのタスクに対する計画を作成し、"
+            "次にクリティックとしてその計画をレビューしてください。\n"
+            "必ず次の形式で応答してください:\n"
+            f"{self.PLAN_START}計画{self.PLAN_END}"
+            f"{self.CRITIQUE_START}改善案{self.CRITIQUE_END}"
+        )
+
+    @staticmethod
+    def _extract(text: str, start: str, *ends: str) -> str:
+        """
+        `start`のマーカーの後ろから、`ends`のいずれかのマーカーの手前までを取り出します。
+        終わりのマーカーが出力されなかった場合でも、次の区切りの手前で切り取れるようにします。
+        """
+        if start not in text:
+            return ""
+        section = text.split(start, 1)[1]
+        for end in ends:
+            section = section.split(end, 1)[0]
+        return section.strip()
+
+    async def reply(self, x: Msg) -> Msg:
+        prompt = await self.formatter.format(
+            [
+                Msg(name="system", content=self.sys_prompt, role="system"),
+                *await self.memory.get_memory(),
+                x,
+            ],
+        )
+        response = await self.model(prompt)
+        if isinstance(response, ChatResponse):
+            blocks = response.content
+        else:
+            # ストリーミングの場合は、生成された分を順次コンソールに表示します。
+            # 各チャンクには、それまでに生成された内容全体が含まれています。
+            stream_msg = Msg(name=self.name, content=[], role="assistant")
+            async for chunk in response:
+                stream_msg.content = chunk.content
+                await self.print(stream_msg, False)
+            await self.print(stream_msg, True)
+            blocks = stream_msg.content
+        text = "".join(block["text"] for block in blocks if block["type"] == "text")
+
+        plan = self._extract(text, self.PLAN_START, self.PLAN_END, self.CRITIQUE_START)
+        critique = self._extract(text, self.CRITIQUE_START, self.CRITIQUE_END)
+        if not plan:
+            # モデルが形式に従わなかった場合は、出力全体を計画案として扱います。
+            plan = text.strip()
+
+        reply_msg = Msg(
+            name=self.name,
+            content=text,
+            role="assistant",
+            metadata={"plan": plan, "critique": critique},
+        )
+        await self.memory.add([x, reply_msg])
+        return reply_msg
+
+    async def observe(self, msg: Msg | list[Msg] | None) -> None:
+        """応答せずに、受け取ったメッセージをメモリに記録します。"""
+        await self.memory.add(msg)
+
+    async def handle_interrupt(self, x: Msg | None = None) -> Msg:
+        """
+        生成中にCtrl+Cで中断された場合に呼び出され、中断したことを伝えるメッセージを返します。
+        呼び出し側が通常の応答と同じように扱えるよう、`metadata`にも同じ項目を格納します。
+        """
+        content = "計画の立案とレビューを中断しました。"
+        reply_msg = Msg(
+            name=self.name,
+            content=content,
+            role="assistant",
+            metadata={"plan": content, "critique": "", "_is_interrupted": True},
+        )
+        await self.print(reply_msg, True)
+        await self.memory.add([x, reply_msg] if x is not None else reply_msg)
+        return reply_msg
+
+
+# --- 0-2. 複数タスクのまとめ処理 ---
+# `--batch` オプションを指定した場合に使用します。
+async def run_batch(
+    task_file: str,
+    batch_size: int,
+    model: OllamaChatModel,
+    planner_sys_prompt: str,
+    critic_sys_prompt: str,
+) -> None:
+    """
+    ファイルに書かれた複数のタスクについて、計画の立案とレビューを行います。
+
+    タスクを文字数の順に並べ替えて`batch_size`件ずつのグループに分け、
+    グループ内のタスクは`asyncio.gather`で同時にOllamaへ送信します。
+    長さの近いリクエストをまとめることで、同時に処理されるリクエストの処理時間が揃い、
+    短いタスクが長いタスクの完了を待つ無駄を減らせます。
+    一部のタスクでエラーが発生しても、他のタスクの結果はそのまま表示します。
+    ※ Ollama側で同時に処理させるには、`OLLAMA_NUM_PARALLEL` を `batch_size` 以上に設定してください。
+    """
+    with open(task_file, encoding="utf-8") as f:
+        tasks = [line.strip() for line in f if line.strip()]
+
+    # エージェントはメモリ（会話の履歴）を持つため、同じエージェントを同時に呼び出すと
+    # 別々のタスクの履歴が混ざってしまいます。そのため、タスクごとにエージェントを作成します。
+    # 出力が入り混じらないよう、エージェント自身によるコンソール表示は無効にします。
+    def create_agent(name: str, sys_prompt: str) -> ReActAgent:
+        agent = ReActAgent(
+            name=name,
+            sys_prompt=sys_prompt,
+            model=model,
+            formatter=OllamaChatFormatter(),
+        )
+        agent.set_console_output_enabled(False)
+        return agent
+
+    order = sorted(range(len(tasks)), key=lambda i: len(tasks[i]))
+    results: dict[int, tuple[Msg | BaseException, Msg | BaseException | None]] = {}
+    for start in range(0, len(order), batch_size):
+        group = order[start:start + batch_size]
+        print(f"\n--- タスク {start + 1}〜{start + len(group)} / {len(tasks)} 件目を処理中... ---")
+
+        planners = [create_agent("プランナー", planner_sys_prompt) for _ in group]
+        critics = [create_agent("クリティック", critic_sys_prompt) for _ in group]
+
+        # グループ内のタスクの計画を同時に立案し、続けてそれぞれのレビューを同時に行います。
+        # `return_exceptions=True`を指定し、失敗したタスクの例外を結果として受け取ることで、
+        # 1件の失敗で同じグループの他のタスクの結果が失われないようにします。
+        plan_results = await asyncio.gather(*[
+            planner(Msg(name="ユーザー", content=tasks[i], role="user"))
+            for planner, i in zip(planners, group)
+        ], return_exceptions=True)
+        # レビューは、計画案の作成に成功したタスクについてだけ行います。
+        reviewable = [
+            (i, critic, plan_result)
+            for i, critic, plan_result in zip(group, critics, plan_results)
+            if isinstance(plan_result, Msg)
+        ]
+        critique_results = await asyncio.gather(*[
+            critic(plan_msg) for _, critic, plan_msg in reviewable
+        ], return_exceptions=True)
+        for i, plan_result in zip(group, plan_results):
+            results[i] = (plan_result, None)
+        for (i, _, plan_msg), critique_result in zip(reviewable, critique_results):
+            results[i] = (plan_msg, critique_result)
+
+    # 結果は、ファイルに書かれていた元の順番で表示します。
+    # 全タスクの結果を1つの文字列にまとめ、1回の書き込みで出力します。
+    output = []
+    for i, task in enumerate(tasks):
+        plan_result, critique_result = results[i]
+        output.append(f"\n★★★ タスク{i + 1}: {task} ★★★\n")
+        if isinstance(plan_result, BaseException):
+            output.append(f"【エラー】計画案の作成に失敗しました: {plan_result}\n")
+        else:
+            output.append(f"【計画案】\n{plan_result.get_text_content()}\n")
+            if isinstance(critique_result, BaseException):
+                output.append(f"\n【エラー】改善案の作成に失敗しました: {critique_result}\n")
+            else:
+                output.append(f"\n【改善案】\n{critique_result.get_text_content()}\n")
+        output.append("★★★★★★★★★★★★★★★★\n")
+    sys.stdout.write("".join(output))
+    sys.stdout.flush()
+
+
+async def unload_model(model: OllamaChatModel) -> None:
+    """
+    `keep_alive=-1` で常駐させたモデルは、プログラムを終了してもOllamaのメモリに残り続けます。
+    終了する前に `keep_alive=0` を指定してモデルを解放し、共有していたHTTPクライアントの接続を閉じます。
+    """
+    await model.client.generate(model=model.model_name, keep_alive=0)
+    await model.client.close()
+
+
+async def main(
+    joint: bool = False,
+    batch_file: str | None = None,
+    batch_size: int = 4,
+):
     # AgentScopeの初期化
     print("AgentScopeを初期化しています...")
     agentscope.init()
 
     # --- 1. モデルの設定 ---
     # 全てのエージェントで共有するモデルを1つ定義します。
+    # `keep_alive=-1` でモデルをメモリに常駐させておくと、各エージェントのシステムプロンプト部分の
+    # KVキャッシュがターンをまたいで再利用されます。
+    # ただし、プランナーとクリティックのキャッシュをそれぞれ保持させるには、Ollamaを
+    # `OLLAMA_NUM_PARALLEL=2` 以上で起動しておく必要があります。（詳しくはREADMEを参照）
+    # モデルを共有すると、Ollamaとの通信に使うHTTPクライアント（接続プール）も
+    # 全エージェントで共有されます。`limits` で接続を保持しておく時間を延ばし、
+    # ユーザーが入力している間に接続が切れて毎ターン接続し直すことがないようにします。
+    # `stream=True` にすると、応答が生成されたそばから少しずつコンソールに表示されます。
     print("Ollamaモデルを設定しています...")
-    llm_model = OllamaChatModel(model_name="gemma:2b")
+    llm_model = OllamaChatModel(
+        model_name="gemma:2b",
+        stream=True,
+        keep_alive=-1,
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=1800),
+    )
     print(f"モデル '{llm_model.model_name}' の設定が完了しました。")
 
+    # 最初のタスクを入力する前に、Ollamaへモデルを読み込ませておきます。
+    print("モデルを読み込んでいます...")
+    await llm_model.client.generate(
+        model=llm_model.model_name,
+        keep_alive=llm_model.keep_alive,
+    )
+
+    # `--batch` が指定された場合は、ファイルのタスクをまとめて処理して終了します。
+    # タスクごとにエージェントを作成するため、以下の対話用のエージェントは作成しません。
+    if batch_file is not None:
+        await run_batch(
+            batch_file,
+            batch_size,
+            llm_model,
+            planner_sys_prompt=PLANNER_SYS_PROMPT,
+            critic_sys_prompt=CRITIC_SYS_PROMPT,
+        )
+        await unload_model(llm_model)
+        return
+
     # --- 2. エージェントの作成 ---
     # (1) プランナーエージェント
     # タスクを受け取り、ステップバイステップの計画を生成する役割。
     print("プランナーエージェントを作成しています...")
     planner_agent = ReActAgent(
         name="プランナー",
-        sys_prompt="あなたは優秀な計画立案者です。ユーザーから与えられたタスクに対して、具体的で実行可能なステップバイステップの計画を作成してください。",
+        sys_prompt=PLANNER_SYS_PROMPT,
         model=llm_model,
         formatter=OllamaChatFormatter(),
     )
@@ -56,12 +320,21 @@ async def main():
     print("クリティックエージェントを作成しています...")
     critic_agent = ReActAgent(
         name="クリティック",
-        sys_prompt="あなたは優秀な批評家です。与えられた計画を注意深くレビューし、その計画の潜在的な問題点、欠けている視点、改善のための具体的な提案を指摘してください。",
+        sys_prompt=CRITIC_SYS_PROMPT,
+        model=llm_model,
+        formatter=OllamaChatFormatter(),
+    )
+
+    # (3) 計画の立案とレビューをまとめて行うエージェント（`--joint` 指定時のみ使用）
+    joint_agent = JointPlannerCritic(
+        name="プランナー&クリティック",
+        planner_sys_prompt=PLANNER_SYS_PROMPT,
+        critic_sys_prompt=CRITIC_SYS_PROMPT,
         model=llm_model,
         formatter=OllamaChatFormatter(),
     )
 
-    # (3) ユーザーエージェント
+    # (4) ユーザーエージェント
     print("ユーザーエージェントを作成しています...")
     user_agent = UserAgent(name="ユーザー")
     print("エージェントの作成が完了しました。\n")
@@ -82,32 +355,115 @@ async def main():
             break
         print(f"\n--- [ユーザー]さんのリクエスト: ---\n{user_msg.content}\n" + "-"*20)
 
-        # (Step 2) プランナーが計画を立案
-        print("\n--- [プランナー]が計画を立案中... ---")
-        plan_msg = await planner_agent(user_msg)
-        print(f"\n--- [プランナー]からの計画案: ---\n{plan_msg.content}\n" + "-"*20)
+        if joint:
+            # (Step 2-3) 計画の立案とレビューを1回のリクエストでまとめて実行
+            print("\n--- [プランナー]と[クリティック]が計画の立案とレビューを実行中... ---")
+            joint_msg = await joint_agent(user_msg)
+            plan_msg = Msg(
+                name=planner_agent.name,
+                content=joint_msg.metadata["plan"],
+                role="assistant",
+            )
+            critique_msg = Msg(
+                name=critic_agent.name,
+                content=joint_msg.metadata["critique"],
+                role="assistant",
+            )
+            sys.stdout.write("".join([
+                f"\n--- [プランナー]からの計画案: ---\n{plan_msg.content}\n" + "-"*20 + "\n",
+                f"\n--- [クリティック]からの改善案: ---\n{critique_msg.content}\n" + "-"*20 + "\n",
+            ]))
+            sys.stdout.flush()
+        else:
+            # (Step 2) プランナーの計画立案と、クリティックによるタスク自体の事前レビューを同時に実行
+            # 2つの処理はどちらもユーザーのリクエストだけを入力とし、互いに独立しているため、
+            # `asyncio.gather` で並行して実行できます。LLMの応答待ちが重なるため、待ち時間を短縮できます。
+            # ※ Ollama側でも同時に処理させるには、環境変数 `OLLAMA_NUM_PARALLEL` を2以上に設定してください。
+            # 2体が同時にストリーミング表示すると出力が混ざってしまうため、この間は各エージェントの
+            # コンソール表示を止め、両方の応答がそろってからまとめて表示します。
+            print("\n--- [プランナー]が計画を立案中、[クリティック]がタスクを事前レビュー中... ---")
+            planner_agent.set_console_output_enabled(False)
+            critic_agent.set_console_output_enabled(False)
+            try:
+                plan_msg, pre_critique_msg = await asyncio.gather(
+                    planner_agent(user_msg),
+                    critic_agent(user_msg),
+                )
+            finally:
+                planner_agent.set_console_output_enabled(True)
+                critic_agent.set_console_output_enabled(True)
+            sys.stdout.write("".join([
+                f"\n--- [プランナー]からの計画案: ---\n{plan_msg.get_text_content()}\n" + "-"*20 + "\n",
+                f"\n--- [クリティック]からの事前レビュー: ---\n{pre_critique_msg.get_text_content()}\n" + "-"*20 + "\n",
+            ]))
+            sys.stdout.flush()
 
-        # (Step 3) クリティックが計画をレビュー
-        print("\n--- [クリティック]が計画をレビュー中... ---")
-        # クリティックには、元のタスクと計画案の両方を渡すことで、より的確な批判が可能になります。
-        # ここでは簡単のため、計画案だけを渡します。
-        critique_msg = await critic_agent(plan_msg)
-        print(f"\n--- [クリティック]からの改善案: ---\n{critique_msg.content}\n" + "-"*20)
+            # (Step 3) クリティックが計画をレビュー
+            # 事前レビューの内容はクリティックのメモリに残っているため、ここでは計画案だけを渡し、
+            # 事前レビューで挙げた観点を踏まえた最終的な改善案を作成させます。
+            print("\n--- [クリティック]が計画をレビュー中... ---")
+            review_request_msg = Msg(
+                name="システム",
+                content=(
+                    "先ほどの事前レビューで挙げた観点も踏まえて、以下の計画案をレビューしてください。\n\n"
+                    f"【計画案】\n{plan_msg.get_text_content()}"
+                ),
+                role="user",
+            )
+            critique_msg = await critic_agent(review_request_msg)
+            print(f"\n--- [クリティック]からの改善案: ---\n{critique_msg.get_text_content()}\n" + "-"*20)
 
         # (Step 4) 最終結果をユーザーに提示
         # 実際には、この後さらにプランナーに修正させたりできますが、
         # このサンプルではクリティックの意見を最終結果として表示します。
-        print("\n★★★ 最終的な提案 ★★★")
-        print("【計画案】\n" + plan_msg.content)
-        print("\n【改善案】\n" + critique_msg.content)
-        print("★★★★★★★★★★★★★★★★\n")
-        print("次のタスクを入力してください。('exit'で終了)")
+        # 複数行の表示は、`print`を繰り返す代わりに1つの文字列にまとめて
+        # `sys.stdout.write`で一度に書き込みます。
+        sys.stdout.write("".join([
+            "\n★★★ 最終的な提案 ★★★\n",
+            f"【計画案】\n{plan_msg.get_text_content()}\n",
+            f"\n【改善案】\n{critique_msg.get_text_content()}\n",
+            "★★★★★★★★★★★★★★★★\n\n",
+            "次のタスクを入力してください。('exit'で終了)\n",
+        ]))
+        sys.stdout.flush()
+
+    await unload_model(llm_model)
 
 
 # --- 4. 非同期関数の実行 ---
+def positive_int(value: str) -> int:
+    """argparse用に、1以上の整数だけを受け付けます。"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"1以上の整数を指定してください: {value}")
+    return number
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="複数エージェントの協調サンプル")
+    # `--batch`は通常の実行方法（計画の立案→レビュー）でタスクを処理するため、
+    # `--joint`とは同時に指定できないようにします。
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        "--joint",
+        action="store_true",
+        help="計画の立案とレビューを1回のLLM呼び出しでまとめて行う",
+    )
+    mode_group.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="1行に1つずつタスクを書いたファイルを読み込み、まとめて処理する",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=positive_int,
+        default=4,
+        help="--batch で同時に処理するタスクの数 (デフォルト: 4)",
+    )
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        run = uvloop_run if uvloop_run is not None else asyncio.run
+        run(main(joint=args.joint, batch_file=args.batch, batch_size=args.batch_size))
     except KeyboardInterrupt:
         print("\nプログラムが中断されました。")
     except Exception as e: